@@ -1,76 +1,543 @@
-import os
 import asyncio
+import gc
+import hashlib
 import logging
+import re
+import sys
+import time
+import tracemalloc
+import weakref
+from collections import deque
+from typing import Annotated, Literal
 
 from aiohttp import web
-from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
+from aiogram import Bot, Dispatcher, F, Router, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
+from aiogram.filters import Command, CommandObject
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+import httpx
+import openai
 from openai import AsyncOpenAI
-from dotenv import load_dotenv
+import tiktoken
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from pydantic import field_validator
+from pydantic_settings import BaseSettings, NoDecode, SettingsConfigDict
+from redis.asyncio import Redis
+import orjson
 
 logging.basicConfig(level=logging.INFO)
 
-# Загружаем переменные окружения из .env (для локального запуска)
-load_dotenv()
 
-TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# ----- Настройки -----
 
-if not TELEGRAM_TOKEN:
-    raise ValueError("Не задан TELEGRAM_TOKEN. Укажи его в переменных окружения или в .env")
+class Config(BaseSettings):
+    # Читается из переменных окружения и из .env (для локального запуска)
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
 
-if not OPENAI_API_KEY:
-    raise ValueError("Не задан OPENAI_API_KEY. Укажи его в переменных окружения или в .env")
+    telegram_token: str = ""
+    openai_api_key: str = ""
 
-bot = Bot(token=TELEGRAM_TOKEN)
-dp = Dispatcher()
+    # Redis для хранения сессий (общий для всех инстансов бота).
+    # Если REDIS_URL не задан — сессии живут в памяти процесса (локальный запуск).
+    redis_url: str | None = None
 
-# Инициализируем клиента OpenAI
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+    # Лимиты аккаунта OpenAI: держимся под ними заранее, а не ловим 429
+    openai_max_requests_per_minute: int = 3500
+    openai_max_tokens_per_minute: int = 90000
 
-# URL, который Render подставляет автоматически (нужен для вебхука)
-RENDER_EXTERNAL_URL = os.getenv("RENDER_EXTERNAL_URL", "").rstrip("/")
+    # Склеивать первые вопросы разных пользователей в один запрос при упоре в RPM.
+    # Выключено по умолчанию: в один контекст модели попадают чужие вопросы.
+    openai_batch_first_turn: bool = False
+
+    # Telegram ID администраторов через запятую (для служебной команды /debug)
+    admin_ids: Annotated[frozenset[int], NoDecode] = frozenset()
+
+    # Режим запуска: "webhook" (по умолчанию, для Render) или "polling" (для локальной отладки)
+    mode: Literal["webhook", "polling"] = "webhook"
+
+    # URL, который Render подставляет автоматически (нужен для вебхука)
+    render_external_url: str = ""
+
+    # Render передаёт порт через переменную PORT
+    port: int = 10000
+
+    @field_validator("admin_ids", mode="before")
+    @classmethod
+    def split_admin_ids(cls, value):
+        if isinstance(value, str):
+            return frozenset(int(x) for x in value.split(",") if x.strip())
+        return value
+
+    # Путь и полный URL вебхука
+    @property
+    def webhook_path(self) -> str:
+        return f"/webhook/{self.telegram_token}"
+
+    @property
+    def webhook_url(self) -> str | None:
+        base_url = self.render_external_url.rstrip("/")
+        return f"{base_url}{self.webhook_path}" if base_url else None
+
+
+def load_config() -> Config:
+    cfg = Config()
+
+    if not cfg.telegram_token:
+        raise ValueError("Не задан TELEGRAM_TOKEN. Укажи его в переменных окружения или в .env")
+
+    if not cfg.openai_api_key:
+        raise ValueError("Не задан OPENAI_API_KEY. Укажи его в переменных окружения или в .env")
+
+    return cfg
+
+
+def json_dumps(value) -> str:
+    # aiogram ожидает str, orjson отдаёт bytes
+    return orjson.dumps(value).decode()
 
-# Путь и полный URL вебхука
-WEBHOOK_PATH = f"/webhook/{TELEGRAM_TOKEN}"
-WEBHOOK_URL = f"{RENDER_EXTERNAL_URL}{WEBHOOK_PATH}" if RENDER_EXTERNAL_URL else None
 
 # ----- Память сессий -----
-# user_sessions = {
-#   user_id: {
-#       "model": "gpt4o",
-#       "messages": [ {"role": "user"/"assistant", "content": "..."} ]
-#   }
+# session = {
+#     "model": "gpt4o",
+#     "roles": deque(["user", "assistant", ...], maxlen=MAX_MESSAGES),
+#     "contents": deque(["текст", "текст", ...], maxlen=MAX_MESSAGES),
+#     "tokens": deque([12, 345, ...], maxlen=MAX_MESSAGES),
 # }
+#
+# История хранится двумя параллельными deque, а не списком словарей:
+# словари {"role": ..., "content": ...} собираются только для запроса к OpenAI,
+# см. build_messages.
+#
+# В Redis сессия хранится в двух ключах:
+#   sess:{user_id} — hash, поле "data" с JSON {"model": ...}
+#   hist:{user_id} — list с историей в JSON {"role": ..., "content": ..., "tokens": ...},
+#                    новые сообщения слева (LPUSH)
+
+DEFAULT_MODEL = "gpt4o"
+
+# Верхняя граница хранимой истории (по количеству сообщений).
+# В модель история уходит с обрезкой по токенам, см. trim_history.
+MAX_MESSAGES = 30
+
+# Сессия неактивного пользователя удаляется через сутки (и в Redis, и в памяти)
+SESSION_TTL = 86400
+
+# Сколько сессий держим в памяти, если Redis не подключён
+MAX_LOCAL_SESSIONS = 10_000
+
+
+class SessionStore:
+    # Сессии пользователей: в Redis, если он подключён, иначе в памяти процесса
+
+    def __init__(self, redis: Redis | None = None):
+        self.redis = redis
+        self.local = TTLCache(maxsize=MAX_LOCAL_SESSIONS, ttl=SESSION_TTL)
+
+        # Блокировки для упорядочивания ходов внутри одного чата.
+        # Лок живёт, пока его кто-то держит или ждёт, поэтому словарь не растёт.
+        self.locks = weakref.WeakValueDictionary()
+
+    def lock(self, user_id: int) -> asyncio.Lock:
+        lock = self.locks.get(user_id)
+        if lock is None:
+            lock = self.locks[user_id] = asyncio.Lock()
+        return lock
+
+    async def get(self, user_id: int):
+        if self.redis is None:
+            session = self.local.get(user_id)
+            if session is None:
+                session = {
+                    "model": DEFAULT_MODEL,
+                    "roles": deque(maxlen=MAX_MESSAGES),
+                    "contents": deque(maxlen=MAX_MESSAGES),
+                    "tokens": deque(maxlen=MAX_MESSAGES),
+                }
+            # Повторная запись продлевает TTL: вытесняются только неактивные пользователи
+            self.local[user_id] = session
+            return session
+
+        # Настройки и историю забираем за один запрос к Redis
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hget(f"sess:{user_id}", "data")
+            pipe.lrange(f"hist:{user_id}", 0, MAX_MESSAGES - 1)
+            data, history = await pipe.execute()
+
+        session = orjson.loads(data) if data else {"model": DEFAULT_MODEL}
+        session["roles"] = deque(maxlen=MAX_MESSAGES)
+        session["contents"] = deque(maxlen=MAX_MESSAGES)
+        session["tokens"] = deque(maxlen=MAX_MESSAGES)
+
+        for item in reversed(history):
+            message = orjson.loads(item)
+            # Роли из JSON — новые строки; интернируем, чтобы все сессии делили "user"/"assistant"
+            session["roles"].append(sys.intern(message["role"]))
+            session["contents"].append(message["content"])
+            # В старых записях числа токенов нет — считаем один раз при загрузке
+            tokens = message.get("tokens")
+            if tokens is None:
+                tokens = count_tokens(session["model"], message["content"])
+            session["tokens"].append(tokens)
+        return session
+
+    async def save(self, user_id: int, session: dict):
+        if self.redis is None:
+            return
+
+        key = f"sess:{user_id}"
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, "data", orjson.dumps({"model": session["model"]}))
+            pipe.expire(key, SESSION_TTL)
+            await pipe.execute()
+
+    async def append_message(self, user_id: int, session: dict, role: str, content: str):
+        # deque с maxlen сам вытесняет самые старые сообщения.
+        # Токены считаем один раз здесь, а не на каждом ходу в trim_history.
+        tokens = count_tokens(session["model"], content)
+        session["roles"].append(role)
+        session["contents"].append(content)
+        session["tokens"].append(tokens)
+
+        if self.redis is None:
+            return
+
+        # История обрезается на стороне Redis
+        key = f"hist:{user_id}"
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.lpush(key, orjson.dumps({"role": role, "content": content, "tokens": tokens}))
+            pipe.ltrim(key, 0, MAX_MESSAGES - 1)
+            pipe.expire(key, SESSION_TTL)
+            # Продлеваем и настройки, иначе выбранная модель сбросится раньше истории
+            pipe.expire(f"sess:{user_id}", SESSION_TTL)
+            await pipe.execute()
+
+    async def discard_last_message(self, user_id: int, session: dict):
+        session["roles"].pop()
+        session["contents"].pop()
+        session["tokens"].pop()
+
+        if self.redis is not None:
+            await self.redis.lpop(f"hist:{user_id}")
+
+    async def clear_history(self, user_id: int, session: dict):
+        session["roles"].clear()
+        session["contents"].clear()
+        session["tokens"].clear()
+
+        if self.redis is not None:
+            await self.redis.delete(f"hist:{user_id}")
+
+    async def close(self):
+        if self.redis is not None:
+            await self.redis.aclose()
+
+
+# ----- Бюджет токенов -----
+
+# Сколько токенов истории отправляем в модель и сколько ждём в ответ
+MAX_PROMPT_TOKENS = 6000
+MAX_COMPLETION_TOKENS = 1024
+
+# Кэш токенизаторов по ID модели: создание энкодера tiktoken недешёвое
+# (при первом обращении tiktoken ещё и скачивает словарь, см. warm_encoders)
+_encoders = {}
+
+
+def get_encoder(model_id: str):
+    encoder = _encoders.get(model_id)
+    if encoder is None:
+        try:
+            encoder = tiktoken.encoding_for_model(model_id)
+        except KeyError:
+            # Модель неизвестна этой версии tiktoken — берём токенизатор семейства gpt-4o
+            encoder = tiktoken.get_encoding("o200k_base")
+        _encoders[model_id] = encoder
+    return encoder
+
+
+def warm_encoders():
+    # Загружаем токенизаторы всех моделей при старте: иначе блокирующее скачивание
+    # словаря случится внутри event loop на первом сообщении пользователя
+    for model_id in set(_MODEL_MAP.values()):
+        get_encoder(model_id)
+
+
+def count_tokens(model_code: str, text: str) -> int:
+    # Оценка для бюджета: считаем токенизатором модели, выбранной на момент записи
+    return len(get_encoder(_MODEL_MAP.get(model_code, "gpt-4o")).encode(text))
+
+
+def trim_history(session: dict) -> int:
+    # Выкидываем самые старые сообщения, пока история не влезет в бюджет.
+    # Последнее сообщение пользователя отправляем всегда.
+    # Возвращает количество токенов в оставшейся истории.
+    roles, contents, tokens = session["roles"], session["contents"], session["tokens"]
+    total = sum(tokens)
+
+    while total >= MAX_PROMPT_TOKENS and len(contents) > 1:
+        roles.popleft()
+        contents.popleft()
+        total -= tokens.popleft()
+
+    return total
+
+
+def build_messages(session: dict) -> list:
+    # Формат истории для OpenAI API; словари живут только на время запроса
+    return [
+        {"role": role, "content": content}
+        for role, content in zip(session["roles"], session["contents"])
+    ]
+
+
+# ----- Запросы к OpenAI -----
+
+# Временные ошибки, после которых имеет смысл повторить запрос
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+OPENAI_MAX_ATTEMPTS = 5
+OPENAI_MAX_BACKOFF = 30
+
+_backoff = wait_random_exponential(min=1, max=OPENAI_MAX_BACKOFF)
+
+
+def wait_retry_after(retry_state) -> float:
+    # Если OpenAI прислал Retry-After — ждём столько, сколько просят
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return min(float(retry_after), OPENAI_MAX_BACKOFF)
+            except ValueError:
+                pass
+    return _backoff(retry_state)
+
+
+# Кэш ответов на первый вопрос нового чата: без истории ответ зависит только
+# от модели и текста, а такие вопросы («что ты умеешь?») часто повторяются
+RESPONSE_CACHE_SIZE = 2048
+RESPONSE_CACHE_TTL = 600
+
+_response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+
+def response_cache_key(model_id: str, text: str):
+    return model_id, hashlib.sha256(text.encode()).digest()
+
+
+# ----- Объединение запросов -----
+# Когда упираемся в лимит запросов в минуту (а не токенов), первые вопросы
+# разных пользователей к одной модели склеиваем в один запрос с метками ###N###
+# и раскладываем ответ обратно по меткам.
+
+BATCH_MAX_SIZE = 4
+BATCH_WAIT = 0.05
+
+BATCH_SYSTEM_PROMPT = (
+    "You will receive several independent questions from different users. "
+    "Each question starts with a marker like ###1###. "
+    "Answer each question independently, in the language it was asked in, "
+    "and start each answer with the same marker as its question."
+)
+
+_BATCH_MARKER = re.compile(r"###(\d+)###")
+
+# Ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+_background_tasks = set()
+
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def strip_batch_markers(text: str) -> str:
+    # Метки из текста пользователя убираем, иначе он мог бы подставить ответ в чужой вопрос.
+    # Повторяем, пока метки не кончатся: после удаления из остатков может сложиться новая.
+    while True:
+        text, count = _BATCH_MARKER.subn("", text)
+        if not count:
+            return text
+
+
+def split_batch_reply(text: str, size: int) -> dict | None:
+    # "###1### ответ ###2### ответ" -> {1: "ответ", 2: "ответ"}.
+    # None, если метка повторяется или выходит за 1..size: значит, в ответ
+    # подмешан чужой текст, и раскладывать его по пользователям нельзя.
+    parts = _BATCH_MARKER.split(text)
+    replies = {}
+    seen = set()
+    for number, body in zip(parts[1::2], parts[2::2]):
+        number = int(number)
+        if number in seen or not 1 <= number <= size:
+            return None
+        seen.add(number)
+        if body.strip():
+            replies[number] = body.strip()
+    return replies
+
+
+class LLM:
+    # Клиент OpenAI вместе с лимитами аккаунта и очередью объединения запросов
+
+    def __init__(
+        self,
+        client: AsyncOpenAI,
+        max_requests_per_minute: int,
+        max_tokens_per_minute: int,
+        batching: bool = False,
+    ):
+        self.client = client
+        self.rpm = AsyncLimiter(max_requests_per_minute, 60)
+        self.tpm = AsyncLimiter(max_tokens_per_minute, 60)
+        self.batching = batching
+
+        # model_id -> [(текст вопроса, future с ответом)]
+        self._batch_pending = {}
+
+    def should_batch(self) -> bool:
+        # Склеиваем запросы, только если это включено и лимит запросов в минуту исчерпан
+        return self.batching and not self.rpm.has_capacity()
+
+    async def create_completion(self, prompt_tokens: int, **kwargs):
+        # prompt_tokens — оценка размера запроса для лимита токенов в минуту
+        tokens = min(prompt_tokens + kwargs.get("max_tokens", 0), self.tpm.max_rate)
+
+        async for attempt in AsyncRetrying(
+            stop=stop_after_attempt(OPENAI_MAX_ATTEMPTS),
+            wait=wait_retry_after,
+            retry=retry_if_exception_type(RETRYABLE_ERRORS),
+            reraise=True,
+        ):
+            with attempt:
+                async with self.rpm:
+                    await self.tpm.acquire(tokens)
+                    return await self.client.chat.completions.create(**kwargs)
+
+    async def batched_completion(self, model_id: str, text: str):
+        # Возвращает ответ или None, если вопрос нужно отправить отдельным запросом
+        future = asyncio.get_running_loop().create_future()
+        pending = self._batch_pending.setdefault(model_id, [])
+        pending.append((text, future))
+
+        if len(pending) >= BATCH_MAX_SIZE:
+            _spawn(self._run_batch(model_id, self._batch_pending.pop(model_id)))
+        elif len(pending) == 1:
+            _spawn(self._run_batch_later(model_id, pending))
+
+        return await future
+
+    async def _run_batch_later(self, model_id: str, batch: list):
+        await asyncio.sleep(BATCH_WAIT)
+        # Пачка могла уйти раньше, набрав BATCH_MAX_SIZE, — тогда на её месте уже
+        # следующая со своим таймером, и её не трогаем
+        if self._batch_pending.get(model_id) is batch:
+            await self._run_batch(model_id, self._batch_pending.pop(model_id))
+
+    async def _run_batch(self, model_id: str, batch: list):
+        if not batch:
+            return
+
+        if len(batch) == 1:
+            # Склеивать не с чем — пусть запрос идёт обычным путём, со стримингом
+            batch[0][1].set_result(None)
+            return
+
+        prompt = "\n\n".join(
+            f"###{i}###\n{strip_batch_markers(text)}" for i, (text, _) in enumerate(batch, 1)
+        )
+
+        try:
+            completion = await self.create_completion(
+                len(get_encoder(model_id).encode(prompt)),
+                model=model_id,
+                messages=[
+                    {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt},
+                ],
+                temperature=0.7,
+                max_tokens=MAX_COMPLETION_TOKENS * len(batch),
+            )
+            replies = split_batch_reply(completion.choices[0].message.content or "", len(batch))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if replies is None:
+            logging.warning("В склеенном ответе повторные или лишние метки — вопросы уйдут отдельными запросами")
+            replies = {}
+
+        for i, (_, future) in enumerate(batch, 1):
+            if not future.done():
+                # Если модель пропустила метку, вопрос уйдёт отдельным запросом
+                future.set_result(replies.get(i))
+
+    async def close(self):
+        await self.client.close()
+
 
-user_sessions = {}
+# Маппинг "красивых" названий на реальные ID моделей OpenAI
+_MODEL_MAP = {
+    "gpt5_instance": "gpt-4o-mini",   # условно "быстрая"
+    "gpt5_syncing": "gpt-4.1",        # условно "глубокая"
+    "gpt4o": "gpt-4o",
+}
 
 
-def get_user_session(user_id: int):
-    if user_id not in user_sessions:
-        user_sessions[user_id] = {
-            "model": "gpt4o",   # модель по умолчанию
-            "messages": []
-        }
-    return user_sessions[user_id]
+# ----- Тексты -----
 
+START_TEXT = (
+    "Привет, я виртуальный помощник, написанный самим искусственным интеллектом 🤖 "
+    "почти без участия человека.\n\n"
+    "Выбери модель и начнём!"
+)
 
-def map_model_code_to_openai_id(model_code: str) -> str:
-    # Маппинг "красивых" названий на реальные ID моделей OpenAI
-    if model_code == "gpt5_instance":
-        return "gpt-4o-mini"   # условно "быстрая"
-    if model_code == "gpt5_syncing":
-        return "gpt-4.1"       # условно "глубокая"
-    if model_code == "gpt4o":
-        return "gpt-4o"
-    return "gpt-4o"
+CHOOSE_MODEL_TEXT = "Выбери модель для AistaiBot:"
+
+NEW_CHAT_TEXT = "Начали новый чат 🧹\nМожешь задать первый вопрос."
+
+ABOUT_TEXT = (
+    "🤖 AistaiBot\n"
+    "ИИ-помощник на базе моделей OpenAI.\n"
+    "У каждого пользователя свой отдельный контекст диалога.\n"
+    "Создан практически без участия человека 😉"
+)
+
+MAIN_MENU_TEXT = "Главное меню:"
+
+# Заглушка, которую показываем, пока модель не прислала первые токены
+PLACEHOLDER_TEXT = "…"
+
+OPENAI_ERROR_TEXT = (
+    "⚠️ Произошла ошибка при обращении к модели.\n"
+    "Проверь, что OpenAI API ключ и ID модели указаны верно."
+)
 
 
 # ----- Клавиатуры -----
 
-def main_menu():
+MODELS = [
+    ("GPT-5 Instance", "gpt5_instance"),
+    ("GPT-5 Syncing", "gpt5_syncing"),
+    ("GPT-4o", "gpt4o"),
+]
+
+_MODEL_NAMES = {code: title for title, code in MODELS}
+
+
+def _build_main_menu():
     kb = InlineKeyboardBuilder()
     kb.button(text="🧠 Change model", callback_data="change_model")
     kb.button(text="🧹 New chat", callback_data="new_chat")
@@ -79,16 +546,10 @@ def main_menu():
     return kb.as_markup()
 
 
-def model_menu(current_model: str):
+def _build_model_menu(current_model: str):
     kb = InlineKeyboardBuilder()
 
-    models = [
-        ("GPT-5 Instance", "gpt5_instance"),
-        ("GPT-5 Syncing", "gpt5_syncing"),
-        ("GPT-4o", "gpt4o"),
-    ]
-
-    for title, code in models:
+    for title, code in MODELS:
         label = f"✅ {title}" if code == current_model else title
         kb.button(text=label, callback_data=f"set_model:{code}")
 
@@ -97,161 +558,411 @@ def model_menu(current_model: str):
     return kb.as_markup()
 
 
+# Клавиатуры не меняются после сборки, поэтому строим их один раз
+# и переиспользуем для всех пользователей
+_MAIN_MENU = _build_main_menu()
+_MODEL_MENUS = {code: _build_model_menu(code) for _, code in MODELS}
+
+
 # ----- Обработчики -----
+# store (SessionStore), llm (LLM) и cfg (Config) aiogram подставляет
+# в обработчики из данных диспетчера, см. build_dispatcher
 
-@dp.message(Command("start"))
-async def cmd_start(message: types.Message):
-    user_id = message.from_user.id
-    get_user_session(user_id)
+router = Router()
+
+# Как часто обновляем сообщение во время стриминга ответа (секунды).
+# Telegram пропускает примерно одно сообщение в секунду на чат.
+STREAM_EDIT_INTERVAL = 1.0
+
+# Максимальная длина текста одного сообщения Telegram
+TELEGRAM_MAX_LENGTH = 4096
 
-    text = (
-        "Привет, я виртуальный помощник, написанный самим искусственным интеллектом 🤖 "
-        "почти без участия человека.\n\n"
-        "Выбери модель и начнём!"
+# Сколько раз пережидаем flood control при отправке итогового ответа
+TELEGRAM_MAX_ATTEMPTS = 5
+
+
+async def safe_edit_text(message: types.Message, text: str, reply_markup=None):
+    try:
+        await message.edit_text(text, reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        # Текст и клавиатура уже такие же (например, повторное нажатие той же кнопки)
+        if "message is not modified" not in str(e):
+            raise
+
+
+async def edit_callback_message(callback: types.CallbackQuery, text: str, reply_markup):
+    # Редактирование и ответ на callback отправляем в Telegram параллельно
+    await asyncio.gather(
+        safe_edit_text(callback.message, text, reply_markup),
+        callback.answer(),
     )
 
-    await message.answer(text, reply_markup=main_menu())
 
+async def retry_after_flood(call):
+    # Итоговый ответ должен дойти: при flood control ждём, сколько просит Telegram
+    for attempt in range(TELEGRAM_MAX_ATTEMPTS):
+        try:
+            return await call()
+        except TelegramRetryAfter as e:
+            if attempt == TELEGRAM_MAX_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(e.retry_after)
 
-@dp.callback_query()
-async def handle_callbacks(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    session = get_user_session(user_id)
-    data = callback.data or ""
-
-    # Выбор модели
-    if data == "change_model":
-        await callback.message.edit_text(
-            "Выбери модель для AistaiBot:",
-            reply_markup=model_menu(session["model"])
-        )
-        await callback.answer()
+
+async def deliver_answer(message: types.Message, reply: types.Message | None, answer: str):
+    # Длинный ответ делим на несколько сообщений, меню — под последним
+    chunks = [
+        answer[i:i + TELEGRAM_MAX_LENGTH]
+        for i in range(0, len(answer), TELEGRAM_MAX_LENGTH)
+    ]
+
+    for i, chunk in enumerate(chunks):
+        markup = _MAIN_MENU if i == len(chunks) - 1 else None
+
+        if i == 0 and reply is not None:
+            try:
+                await retry_after_flood(lambda: safe_edit_text(reply, chunk, markup))
+                continue
+            except TelegramBadRequest:
+                # Заглушку удалили или её нельзя отредактировать — отправляем новым сообщением
+                logging.warning("Не удалось отредактировать сообщение с ответом", exc_info=True)
+
+        await retry_after_flood(lambda: message.answer(chunk, reply_markup=markup))
+
+
+async def stream_answer(stream, reply: types.Message) -> str:
+    # Собираем ответ из кусочков и раз в STREAM_EDIT_INTERVAL секунд
+    # показываем пользователю то, что уже пришло.
+    # Промежуточные правки необязательны: ошибки Telegram здесь не прерывают ответ модели.
+    parts = []
+    shown = ""
+    live = True
+    next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
+
+        now = time.monotonic()
+        if not live or now < next_edit:
+            continue
+        next_edit = now + STREAM_EDIT_INTERVAL
+
+        # Целиком длинный ответ уйдёт в deliver_answer, пока показываем начало
+        text = "".join(parts).strip()[:TELEGRAM_MAX_LENGTH]
+        if text and text != shown:
+            try:
+                await safe_edit_text(reply, text)
+                shown = text
+            except TelegramRetryAfter as e:
+                # Упёрлись в лимит Telegram — следующую правку делаем не раньше, чем разрешат
+                next_edit = now + e.retry_after
+            except TelegramAPIError:
+                # Например, заглушку удалили: дальше не обновляем, итог отправит deliver_answer
+                logging.warning("Промежуточное обновление ответа не удалось", exc_info=True)
+                live = False
+
+    answer = "".join(parts).strip()
+    if not answer:
+        raise ValueError("Модель вернула пустой ответ")
+    return answer
+
+
+async def stream_completion(llm: LLM, session: dict, model_id: str, reply: types.Message) -> str:
+    prompt_tokens = trim_history(session)
+
+    stream = await llm.create_completion(
+        prompt_tokens,
+        model=model_id,
+        messages=build_messages(session),
+        temperature=0.7,
+        max_tokens=MAX_COMPLETION_TOKENS,
+        stream=True,
+    )
+    return await stream_answer(stream, reply)
+
+
+@router.message(Command("start"))
+async def cmd_start(message: types.Message, store: SessionStore):
+    user_id = message.from_user.id
+    session = await store.get(user_id)
+    await store.save(user_id, session)
+
+    await message.answer(START_TEXT, reply_markup=_MAIN_MENU)
+
+
+def top_allocations(limit: int = 10) -> list:
+    # Снимок и сортировка по большой куче занимают заметное время — вызывать вне event loop
+    return tracemalloc.take_snapshot().statistics("lineno")[:limit]
+
+
+@router.message(Command("debug"))
+async def cmd_debug(message: types.Message, command: CommandObject, cfg: Config, store: SessionStore):
+    # Служебная статистика памяти и GC, только для администраторов.
+    # /debug — включить tracemalloc или показать статистику, /debug stop — выключить.
+    if message.from_user.id not in cfg.admin_ids:
         return
 
-    # Новый чат
-    if data == "new_chat":
-        session["messages"] = []
-        await callback.message.edit_text(
-            "Начали новый чат 🧹\nМожешь задать первый вопрос.",
-            reply_markup=main_menu()
-        )
-        await callback.answer()
+    if command.args and command.args.strip() == "stop":
+        # tracemalloc замедляет каждую аллокацию и ест память — не оставляем его включённым
+        tracemalloc.stop()
+        await message.answer("tracemalloc выключен.")
         return
 
-    # О боте
-    if data == "about_bot":
-        about_text = (
-            "🤖 AistaiBot\n"
-            "ИИ-помощник на базе моделей OpenAI.\n"
-            "У каждого пользователя свой отдельный контекст диалога.\n"
-            "Создан практически без участия человека 😉"
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        await message.answer(
+            "tracemalloc включён, повтори /debug чуть позже. "
+            "Не забудь выключить: /debug stop"
         )
-        await callback.message.edit_text(about_text, reply_markup=main_menu())
-        await callback.answer()
         return
 
-    # Назад в меню
-    if data == "back_to_menu":
-        await callback.message.edit_text("Главное меню:", reply_markup=main_menu())
-        await callback.answer()
-        return
+    current, peak = tracemalloc.get_traced_memory()
+    top = await asyncio.to_thread(top_allocations)
 
-    # Установка модели
-    if data.startswith("set_model:"):
-        _, model_code = data.split(":", 1)
-        session["model"] = model_code
-
-        name_map = {
-            "gpt5_instance": "GPT-5 Instance",
-            "gpt5_syncing": "GPT-5 Syncing",
-            "gpt4o": "GPT-4o",
-        }
-        model_name = name_map.get(model_code, model_code)
-
-        await callback.message.edit_text(
-            f"Модель изменена на: {model_name}",
-            reply_markup=main_menu()
-        )
+    lines = [
+        f"Память: {current / 1024 / 1024:.1f} MiB (пик {peak / 1024 / 1024:.1f} MiB)",
+        f"GC count: {gc.get_count()}, threshold: {gc.get_threshold()}",
+        f"GC frozen: {gc.get_freeze_count()}",
+        f"Сессий в памяти: {len(store.local)}",
+        "",
+        "Топ аллокаций:",
+    ]
+    lines.extend(str(stat) for stat in top)
+    lines.append("")
+    lines.append("tracemalloc всё ещё включён, выключить: /debug stop")
+
+    await message.answer("\n".join(lines))
+
+
+# ----- Кнопки -----
+
+# Выбор модели
+@router.callback_query(F.data == "change_model")
+async def cb_change_model(callback: types.CallbackQuery, store: SessionStore):
+    session = await store.get(callback.from_user.id)
+    await edit_callback_message(callback, CHOOSE_MODEL_TEXT, _MODEL_MENUS[session["model"]])
+
+
+# Новый чат
+@router.callback_query(F.data == "new_chat")
+async def cb_new_chat(callback: types.CallbackQuery, store: SessionStore):
+    user_id = callback.from_user.id
+    async with store.lock(user_id):
+        session = await store.get(user_id)
+        await store.clear_history(user_id, session)
+    await edit_callback_message(callback, NEW_CHAT_TEXT, _MAIN_MENU)
+
+
+# О боте
+@router.callback_query(F.data == "about_bot")
+async def cb_about_bot(callback: types.CallbackQuery):
+    await edit_callback_message(callback, ABOUT_TEXT, _MAIN_MENU)
+
+
+# Назад в меню
+@router.callback_query(F.data == "back_to_menu")
+async def cb_back_to_menu(callback: types.CallbackQuery):
+    await edit_callback_message(callback, MAIN_MENU_TEXT, _MAIN_MENU)
+
+
+# Установка модели: callback_data вида "set_model:<code>"
+@router.callback_query(F.data.startswith("set_model:"))
+async def cb_set_model(callback: types.CallbackQuery, store: SessionStore):
+    _, _, model_code = callback.data.partition(":")
+    if model_code not in _MODEL_MENUS:
         await callback.answer()
         return
 
-    await callback.answer()
+    user_id = callback.from_user.id
+    session = await store.get(user_id)
+    session["model"] = model_code
+    await store.save(user_id, session)
+    model_name = _MODEL_NAMES[model_code]
 
+    await edit_callback_message(callback, f"Модель изменена на: {model_name}", _MAIN_MENU)
 
-@dp.message()
-async def handle_message(message: types.Message):
-    if not message.text:
-        return
 
+# Неизвестная кнопка (например, из старой клавиатуры): просто убираем «часики»
+@router.callback_query()
+async def cb_unknown(callback: types.CallbackQuery):
+    await callback.answer()
+
+
+# Фото, стикеры и прочие сообщения без текста до обработчика не доходят
+@router.message(F.text)
+async def handle_message(message: types.Message, store: SessionStore, llm: LLM):
     user_id = message.from_user.id
-    session = get_user_session(user_id)
+    reply = None
+
+    # Сообщения одного пользователя обрабатываются строго по очереди,
+    # чтобы ходы не перемешивались в истории. Разные пользователи не ждут друг друга.
+    async with store.lock(user_id):
+        session = await store.get(user_id)
+
+        model_code = session["model"]
+        openai_model_id = _MODEL_MAP.get(model_code, "gpt-4o")
+
+        # Первый вопрос без контекста можно взять из кэша ответов
+        cache_key = None
+        if not session["contents"]:
+            cache_key = response_cache_key(openai_model_id, message.text)
+        answer = _response_cache.get(cache_key) if cache_key else None
+
+        # Добавляем сообщение пользователя в историю
+        await store.append_message(user_id, session, "user", message.text)
+
+        if answer is None:
+            batched = False
+            try:
+                # Упёрлись в лимит запросов в минуту: первый вопрос отправляем вместе с чужими
+                if cache_key and llm.should_batch():
+                    answer = await llm.batched_completion(openai_model_id, message.text)
+                    batched = answer is not None
+
+                if answer is None:
+                    reply = await retry_after_flood(lambda: message.answer(PLACEHOLDER_TEXT))
+                    answer = await stream_completion(llm, session, openai_model_id, reply)
+            except TelegramAPIError:
+                # Telegram не принял заглушку — это не ошибка модели: убираем вопрос
+                # из истории и отдаём исключение aiogram, он его залогирует
+                await store.discard_last_message(user_id, session)
+                raise
+            except Exception:
+                logging.exception("Ошибка при запросе к OpenAI")
+                # Убираем вопрос из истории, чтобы при повторной отправке он не задублировался
+                await store.discard_last_message(user_id, session)
+                answer = OPENAI_ERROR_TEXT
+            else:
+                # Ответ из склеенного запроса мог зависеть от чужих вопросов — не кэшируем
+                if cache_key and not batched:
+                    _response_cache[cache_key] = answer
+
+                # Сохраняем ответ ассистента в историю
+                await store.append_message(user_id, session, "assistant", answer)
+        else:
+            # Ответ из кэша тоже становится частью истории
+            await store.append_message(user_id, session, "assistant", answer)
+
+    await deliver_answer(message, reply, answer)
+
+
+# ----- Запуск: webhook (Render) или polling (локально) -----
+
+# Пороги GC (по умолчанию в CPython 700, 10, 10)
+GC_THRESHOLD = (10000, 20, 20)
+
+
+async def on_startup(bot: Bot, cfg: Config):
+    if cfg.webhook_url:
+        await bot.set_webhook(cfg.webhook_url)
+        logging.info(f"Webhook установлен: {cfg.webhook_url}")
+    else:
+        logging.warning("RENDER_EXTERNAL_URL не задан, webhook не установлен.")
 
-    model_code = session["model"]
-    openai_model_id = map_model_code_to_openai_id(model_code)
 
-    # Добавляем сообщение пользователя в историю
-    session["messages"].append({"role": "user", "content": message.text})
+async def on_shutdown(store: SessionStore, llm: LLM):
+    await llm.close()
+    await store.close()
 
-    # Ограничиваем длину истории (по количеству сообщений, а не символов)
-    max_messages = 30
-    if len(session["messages"]) > max_messages:
-        session["messages"] = session["messages"][-max_messages:]
 
-    try:
-        completion = await client.chat.completions.create(
-            model=openai_model_id,
-            messages=session["messages"],
-            temperature=0.7,
-        )
-        answer = completion.choices[0].message.content.strip()
-    except Exception as e:
-        logging.exception("Ошибка при запросе к OpenAI")
-        answer = (
-            "⚠️ Произошла ошибка при обращении к модели.\n"
-            "Проверь, что OpenAI API ключ и ID модели указаны верно."
-        )
+def build_dispatcher(cfg: Config) -> tuple[Bot, Dispatcher]:
+    warm_encoders()
 
-    # Сохраняем ответ ассистента в историю
-    session["messages"].append({"role": "assistant", "content": answer})
+    # Запросы к Telegram сериализуем через orjson (как и сессии в Redis)
+    bot = Bot(
+        token=cfg.telegram_token,
+        session=AiohttpSession(json_loads=orjson.loads, json_dumps=json_dumps),
+    )
 
-    await message.answer(answer, reply_markup=main_menu())
+    # Общий пул соединений к OpenAI: держим TLS-соединения открытыми между запросами,
+    # HTTP/2 мультиплексирует параллельные запросы разных пользователей
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=200,
+            max_keepalive_connections=100,
+            keepalive_expiry=90,
+        ),
+    )
 
+    # Инициализируем клиента OpenAI.
+    # Повторы запросов делаем сами (см. LLM.create_completion), встроенные отключаем.
+    client = AsyncOpenAI(api_key=cfg.openai_api_key, max_retries=0, http_client=http_client)
 
-# ----- Webhook / запуск на Render -----
+    llm = LLM(
+        client,
+        cfg.openai_max_requests_per_minute,
+        cfg.openai_max_tokens_per_minute,
+        batching=cfg.openai_batch_first_turn,
+    )
+    store = SessionStore(Redis.from_url(cfg.redis_url) if cfg.redis_url else None)
 
-async def on_startup(bot: Bot):
-    if WEBHOOK_URL:
-        await bot.set_webhook(WEBHOOK_URL)
-        logging.info(f"Webhook установлен: {WEBHOOK_URL}")
-    else:
-        logging.warning("RENDER_EXTERNAL_URL не задан, webhook не установлен.")
+    dp = Dispatcher(cfg=cfg, store=store, llm=llm)
+    dp.include_router(router)
+    dp.shutdown.register(on_shutdown)
+    return bot, dp
 
 
-async def main():
-    logging.info("AistaiBot запускается (webhook режим)...")
+def build_app(cfg: Config) -> web.Application:
+    bot, dp = build_dispatcher(cfg)
 
     app = web.Application()
 
     # Регистрируем функцию on_startup как стартовый хук диспетчера
     dp.startup.register(on_startup)
 
-    # Обработчик запросов от Telegram по пути WEBHOOK_PATH
-    SimpleRequestHandler(dispatcher=dp, bot=bot).register(app, path=WEBHOOK_PATH)
+    # Обработчик запросов от Telegram по пути cfg.webhook_path
+    SimpleRequestHandler(dispatcher=dp, bot=bot).register(app, path=cfg.webhook_path)
 
     # Настраиваем приложение aiogram + webhook
     setup_application(app, dp, bot=bot)
+    return app
 
-    # Render передаёт порт через переменную PORT
-    port = int(os.getenv("PORT", "10000"))
+
+def freeze_startup_objects():
+    # Всё, что создано при старте (клавиатуры, клиенты, модули), живёт до конца процесса:
+    # выводим это из-под сборщика мусора и реже запускаем сборку молодого поколения
+    gc.collect()
+    gc.freeze()
+    gc.set_threshold(*GC_THRESHOLD)
+
+
+async def run_polling(cfg: Config):
+    logging.info("AistaiBot запускается (polling режим)...")
+
+    bot, dp = build_dispatcher(cfg)
+    freeze_startup_objects()
+
+    # Telegram не отдаёт апдейты через getUpdates, пока установлен вебхук
+    await bot.delete_webhook()
+    await dp.start_polling(bot)
+
+
+async def run_webhook(cfg: Config):
+    logging.info("AistaiBot запускается (webhook режим)...")
+
+    app = build_app(cfg)
+    freeze_startup_objects()
 
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", port)
+    site = web.TCPSite(runner, "0.0.0.0", cfg.port)
     await site.start()
 
-    logging.info(f"AistaiBot запущен на порту {port}")
+    logging.info(f"AistaiBot запущен на порту {cfg.port}")
     await asyncio.Event().wait()
 
 
+async def main():
+    # Переменные окружения читаем один раз, при запуске
+    cfg = load_config()
+
+    if cfg.mode == "polling":
+        await run_polling(cfg)
+    else:
+        await run_webhook(cfg)
+
+
 if __name__ == "__main__":
     asyncio.run(main())